@@ -21,6 +21,8 @@ from multiprocessing import Pool
 import os
 import shutil
 
+import numpy as np
+
 
 def main(args):
     import_user_module(args)
@@ -115,7 +117,8 @@ def main(args):
             pool.close()
 
         ds = indexed_dataset.IndexedDatasetBuilder(
-            dataset_dest_file(args, output_prefix, lang, "bin")
+            dataset_dest_file(args, output_prefix, lang, "bin"),
+            dtype=token_dtype(vocab)
         )
         merge_result(
             Binarizer.binarize(
@@ -219,7 +222,8 @@ def main(args):
 
 def binarize(args, filename, vocab, output_prefix, lang, offset, end, append_eos=True):
     ds = indexed_dataset.IndexedDatasetBuilder(
-        dataset_dest_file(args, output_prefix, lang, "bin")
+        dataset_dest_file(args, output_prefix, lang, "bin"),
+        dtype=token_dtype(vocab)
     )
 
     def consumer(tensor):
@@ -231,6 +235,13 @@ def binarize(args, filename, vocab, output_prefix, lang, offset, end, append_eos
     return res
 
 
+def token_dtype(vocab):
+    # Every BERT vocabulary except the multilingual ones has fewer than 32k
+    # entries, so its ids (plus the one-based offset of the index) fit int16,
+    # which halves the size of the binarized corpus.
+    return np.int16 if len(vocab) + 1 < 2 ** 15 else np.int32
+
+
 def dataset_dest_prefix(args, output_prefix, lang):
     base = "{}/{}".format(args.destdir, output_prefix)
     lang_part = (
@@ -66,6 +66,9 @@ def main(args, init_distributed=False):
     )
     dummy_batch = task.dataset('train').get_dummy_batch(args.max_tokens, max_positions)
     oom_batch = task.dataset('train').get_dummy_batch(1, max_positions)
+    # Tell the task these placeholders apart from real batches.
+    dummy_batch['dummy'] = True
+    oom_batch['dummy'] = True
 
     # Build trainer
     trainer = Trainer(args, task, model, criterion, dummy_batch, oom_batch)
@@ -129,6 +132,8 @@ def train(args, trainer, task, epoch_itr):
         fix_batches_to_gpus=args.fix_batches_to_gpus,
         shuffle=(epoch_itr.epoch >= args.curriculum),
     )
+    if torch.cuda.is_available() and not args.cpu:
+        itr = CudaPrefetcher(itr)
     itr = iterators.GroupedIterator(itr, update_freq)
     progress = progress_bar.build_progress_bar(
         args, itr, epoch_itr.epoch, no_progress_bar='simple',
@@ -181,6 +186,62 @@ def train(args, trainer, task, epoch_itr):
             meter.reset()
 
 
+class CudaPrefetcher(object):
+    """Copy the next sample to the GPU on a side stream while the current
+    one is being trained on.
+
+    The trainer's own move to CUDA then finds tensors already on the device
+    and leaves them as they are.
+    """
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __iter__(self):
+        it = iter(self.iterable)
+        sample = self._preload(it)
+        while sample is not None:
+            current = torch.cuda.current_stream()
+            current.wait_stream(self.stream)
+            self._record_stream(sample, current)
+            next_sample = self._preload(it)
+            yield sample
+            sample = next_sample
+
+    def _preload(self, it):
+        try:
+            sample = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_cuda(sample)
+
+    def _to_cuda(self, x):
+        if torch.is_tensor(x):
+            return x.pin_memory().cuda(non_blocking=True)
+        elif isinstance(x, dict):
+            return {k: self._to_cuda(v) for k, v in x.items()}
+        elif isinstance(x, list):
+            return [self._to_cuda(v) for v in x]
+        return x
+
+    def _record_stream(self, x, stream):
+        # The copies were allocated on the side stream but are used on the
+        # current one; tell the caching allocator not to reuse them early.
+        if torch.is_tensor(x):
+            x.record_stream(stream)
+        elif isinstance(x, dict):
+            for v in x.values():
+                self._record_stream(v, stream)
+        elif isinstance(x, list):
+            for v in x:
+                self._record_stream(v, stream)
+
+
 def get_training_stats(trainer):
     stats = collections.OrderedDict()
     stats['loss'] = trainer.get_meter('train_loss')
@@ -304,8 +365,12 @@ def save_checkpoint(args, trainer, epoch_itr, val_loss):
     prev_best = getattr(save_checkpoint, 'best', val_loss)
     if val_loss is not None:
         save_checkpoint.best = min(val_loss, prev_best)
+    train_iterator = epoch_itr.state_dict()
+    if not end_of_epoch and torch.cuda.is_available() and not args.cpu:
+        # CudaPrefetcher has already taken the next batch off the iterator.
+        train_iterator['iterations_in_epoch'] -= 1
     extra_state = {
-        'train_iterator': epoch_itr.state_dict(),
+        'train_iterator': train_iterator,
         'val_loss': val_loss,
     }
     if hasattr(save_checkpoint, 'best'):
@@ -1,10 +1,17 @@
 import argparse
+import copy
+import functools
+import itertools
 import os.path
+import shutil
+import types
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 
 import fairseq.tokenizer
-from fairseq import options, utils
+from fairseq import distributed_utils, options, utils
 from fairseq.models import (
     transformer, register_model, register_model_architecture,
     FairseqModel, FairseqEncoder
@@ -16,7 +23,7 @@ from fairseq.tasks import (
     register_task, translation
 )
 from pytorch_pretrained_bert.tokenization import BertTokenizer
-from pytorch_pretrained_bert.modeling import BertModel
+from pytorch_pretrained_bert.modeling import BertConfig, BertModel, BertSelfAttention
 
 
 class BertCompatibleDictionary(Dictionary):
@@ -25,18 +32,24 @@ class BertCompatibleDictionary(Dictionary):
         #super().__init__()
 
         self.unk_word, self.pad_word, self.eos_word = unk, pad, eos
-        self.symbols = []
-        self.count = []
-        self.indices = {}
-        self.pad_index = self.add_symbol(pad)
-        for i in range(1, 100):
-            self.add_symbol('[unused%d]' % i)
-        self.unk_index = self.add_symbol(unk)
-        self.add_symbol('<bos>')
-        self.eos_index = self.add_symbol(eos)
+        # Mirror the BERT vocabulary layout: [PAD], [unused1-99], [UNK],
+        # [CLS], [SEP] occupy ids 0-102.
+        self.symbols = [pad] + ['[unused%d]' % i for i in range(1, 100)] + [unk, '<bos>', eos]
+        self.count = [1] * len(self.symbols)
+        self.indices = {s: i for i, s in enumerate(self.symbols)}
+        self.pad_index = self.indices[pad]
+        self.unk_index = self.indices[unk]
+        self.eos_index = self.indices[eos]
         self.nspecial = len(self.symbols)
 
 
+@functools.lru_cache(maxsize=8)
+def _get_tokenizer(name: str, lower: bool, never_split: tuple):
+    # BertTokenizer is read-only once loaded, so one instance can be shared
+    # by every dictionary created for the same model in this process.
+    return BertTokenizer.from_pretrained(name, never_split=list(never_split), do_lower_case=lower)
+
+
 class BertBasedDictionary:
     def __init__(self, name: str):
         self.__tokenizer = self.__create_tokenizer(name)
@@ -53,18 +66,16 @@ class BertBasedDictionary:
             'mm', 'm',
             'ns', 'ms', 's', 'min', 'hr', 'h'
         )
-        never_split = ['[PAD]', '[UNK]', '[CLS]', '[SEP]']
-        for s in suffix:
-            never_split.append('##' + s)
-        for i in range(10):
-            never_split.append('##' + str(i))
+        never_split = ('[PAD]', '[UNK]', '[CLS]', '[SEP]') + \
+            tuple('##' + s for s in suffix) + \
+            tuple('##' + str(i) for i in range(10))
 
         lower = (name == 'bert-base-chinese' or name.find('uncased') >= 0)
 
-        return BertTokenizer.from_pretrained(name, never_split=never_split, do_lower_case=lower)
+        return _get_tokenizer(name, lower, never_split)
 
     def dummy_sentence(self, length):
-        t = torch.Tensor(length).uniform_(self.eos() + 2, len(self)).long()
+        t = torch.randint(self.eos() + 2, len(self), (length,), dtype=torch.long)
         t[-1] = self.eos()
         return t
 
@@ -81,21 +92,21 @@ class BertBasedDictionary:
         Can optionally remove BPE symbols or escape <unk> words.
         """
         if torch.is_tensor(tensor) and tensor.dim() == 2:
-            return '\n'.join(self.string(t) for t in tensor)
+            n = tensor.size(1)
+            tk = self.__tokenizer.convert_ids_to_tokens(tensor.detach().cpu().reshape(-1).tolist())
+            return '\n'.join(' '.join(tk[i * n:(i + 1) * n]) for i in range(tensor.size(0)))
 
-        tk = self.__tokenizer.convert_ids_to_tokens([x.item() for x in tensor])
+        ids = tensor.detach().cpu().tolist() if torch.is_tensor(tensor) else list(tensor)
+        tk = self.__tokenizer.convert_ids_to_tokens(ids)
         return ' '.join(tk)
 
     def encode_line(self, line, reverse_order=False, **kwargs):
-        words = self.__tokenizer.tokenize(line)
-        if len(words) > 512:
-            print(line)
-        if reverse_order:
-            words = list(reversed(words))
-        words.insert(0, '[CLS]')
-        words.append('[SEP]')
-        ids = self.__tokenizer.convert_tokens_to_ids(words)
-        return torch.IntTensor(ids)
+        ids = self.__tokenizer.convert_tokens_to_ids(self.__tokenizer.tokenize(line))
+        arr = np.empty(len(ids) + 2, dtype=np.int32)
+        arr[0] = self.__bos
+        arr[-1] = self.__eos
+        arr[1:-1] = ids[::-1] if reverse_order else ids
+        return torch.from_numpy(arr)
 
     def pad(self):
         return self.__pad
@@ -110,50 +121,320 @@ class BertBasedDictionary:
         return self.__eos
 
 
+def _load_pretrained_bert(args: argparse.Namespace):
+    # In distributed training only the master reads the pretrained weights;
+    # the other ranks build an empty model from its config and receive the
+    # parameters by broadcast.
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return BertModel.from_pretrained(args.bert_name)
+
+    if distributed_utils.is_master(args):
+        bert = BertModel.from_pretrained(args.bert_name)
+        config = bert.config.to_dict()
+    else:
+        bert, config = None, None
+    config = distributed_utils.all_gather_list(config)[0]
+    if bert is None:
+        bert = BertModel(BertConfig.from_dict(config))
+
+    if torch.cuda.is_available() and not args.cpu:
+        bert.cuda()
+    for t in itertools.chain(bert.parameters(), bert.buffers()):
+        torch.distributed.broadcast(t.data, src=0)
+    return bert
+
+
+def _sdpa_self_attention_forward(self, hidden_states, attention_mask):
+    # Drop-in BertSelfAttention.forward built on the fused attention kernels of
+    # PyTorch 2.
+    bsz, seq_len = hidden_states.size(0), hidden_states.size(1)
+
+    def shape(x):
+        return x.view(bsz, seq_len, self.num_attention_heads, self.attention_head_size).transpose(1, 2)
+
+    q = shape(self.query(hidden_states))
+    k = shape(self.key(hidden_states))
+    v = shape(self.value(hidden_states))
+    # attention_mask is BERT's additive (B, 1, 1, L) mask of 0 / -10000.
+    context = F.scaled_dot_product_attention(q, k, v, attn_mask=attention_mask.type_as(q),
+        dropout_p=self.dropout.p if self.training else 0.)
+    return context.transpose(1, 2).contiguous().view(bsz, seq_len, self.all_head_size)
+
+
+class _DecoderExportWrapper(torch.nn.Module):
+    # The tracer only accepts tensor inputs, while the decoder takes the
+    # encoder output as a dict.
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, prev_output_tokens, encoder_out, encoder_padding_mask):
+        logits, _ = self.decoder(prev_output_tokens, {
+            'encoder_out': encoder_out,
+            'encoder_padding_mask': encoder_padding_mask,
+        })
+        return logits
+
+
+class BertOutputCache:
+    """Per-sentence outputs of a frozen BERT, stored on disk in fp16.
+
+    The outputs live in one ``np.memmap`` arena with a row per source token,
+    laid out by the cumulative source sizes of the training split. Only the
+    non-padding positions are kept, so entries can be re-padded to any batch
+    layout.
+    """
+    def __init__(self, path, src_sizes, hidden_size):
+        src_sizes = np.asarray(src_sizes, dtype=np.int64)
+        self.__offsets = np.zeros(len(src_sizes) + 1, dtype=np.int64)
+        np.cumsum(src_sizes, out=self.__offsets[1:])
+        self.__filled = np.zeros(len(src_sizes), dtype=np.bool_)
+        self.__arena = np.memmap(path, dtype=np.float16, mode='w+',
+            shape=(max(int(self.__offsets[-1]), 1), hidden_size))
+
+    @staticmethod
+    def nbytes(src_sizes, hidden_size):
+        return int(np.sum(src_sizes, dtype=np.int64)) * hidden_size * 2
+
+    def __len__(self):
+        return int(self.__filled.sum())
+
+    def __fits(self, i, length):
+        return self.__offsets[i + 1] - self.__offsets[i] == length
+
+    def lookup(self, sample_ids, lengths):
+        """Return the cached outputs of a batch as one (tokens, hidden) tensor,
+        or None unless all of them are cached with the expected length."""
+        ids = sample_ids.tolist()
+        if not all(self.__filled[i] and self.__fits(i, n) for i, n in zip(ids, lengths)):
+            return None
+        return torch.from_numpy(np.concatenate(
+            [self.__arena[self.__offsets[i]:self.__offsets[i + 1]] for i in ids]))
+
+    def store(self, sample_ids, layer_out, masks):
+        for i, out, mask in zip(sample_ids.tolist(), layer_out, masks):
+            rows = out[mask].detach().to('cpu', torch.half).numpy()
+            if self.__fits(i, rows.shape[0]):
+                self.__arena[self.__offsets[i]:self.__offsets[i + 1]] = rows
+                self.__filled[i] = True
+
+
 class BertTranslationEncoder(FairseqEncoder):
-    def __init__(self, args: argparse.Namespace, dictionary: BertBasedDictionary=None):
+    def __init__(self, args: argparse.Namespace, dictionary: BertBasedDictionary=None,
+            train_src_sizes=None):
         if dictionary is None:
             dictionary = BertBasedDictionary(args.bert_name)
         super().__init__(dictionary)
         self.args = args
-        self.bert = BertModel.from_pretrained(args.bert_name)
-
-    def forward(self, src_tokens, src_lengths):
-        paddings = src_tokens.eq(self.dictionary.pad())
-        masks = paddings ^ 1
+        self.bert = _load_pretrained_bert(args)
+        if hasattr(F, 'scaled_dot_product_attention'):
+            for m in self.bert.modules():
+                if isinstance(m, BertSelfAttention):
+                    m.forward = types.MethodType(_sdpa_self_attention_forward, m)
+        if not args.no_freeze_bert:
+            for p in self.bert.parameters():
+                p.requires_grad = False
+            self.bert.eval()
+            if args.bert_dtype == 'fp16':
+                self.bert.half()
+        self.__quantized = False
+        self.register_buffer('_zero_tti', torch.zeros(1, self.max_positions(), dtype=torch.long))
+        self.cache = None
+        if args.cache_bert_output and not args.no_freeze_bert and train_src_sizes is not None:
+            self.cache = self.__create_cache(args, train_src_sizes)
+
+    def __create_cache(self, args, src_sizes):
+        if getattr(args, 'distributed_world_size', 1) > 1:
+            # Batches are re-sharded every epoch, so each rank would hit only
+            # about 1/world_size of its cache.
+            print('| --cache-bert-output is ignored in distributed training')
+            return None
+        hidden_size = self.bert.config.hidden_size
+        os.makedirs(args.save_dir, exist_ok=True)
+        nbytes = BertOutputCache.nbytes(src_sizes, hidden_size)
+        free = shutil.disk_usage(args.save_dir).free
+        if nbytes > free:
+            print('| --cache-bert-output needs {:.1f} GB but only {:.1f} GB are free in {}, '
+                  'not caching'.format(nbytes / 2 ** 30, free / 2 ** 30, args.save_dir))
+            return None
+        path = os.path.join(args.save_dir, 'bert_cache.bin')
+        print('| caching BERT output in {} ({:.1f} GB)'.format(path, nbytes / 2 ** 30))
+        return BertOutputCache(path, src_sizes, hidden_size)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if not self.args.no_freeze_bert:
+            # Frozen BERT stays in eval mode so that dropout is never applied.
+            self.bert.eval()
+        return self
+
+    def forward(self, src_tokens, src_lengths, sample_ids=None):
+        if self.__quantized and src_tokens.is_cuda:
+            raise RuntimeError('BERT was quantized for CPU with bert_int8_cpu, '
+                               'generate with --cpu or drop the override')
+
+        masks = src_tokens.ne(self.dictionary.pad())
+        paddings = ~masks
+
+        cached = None
+        if self.cache is not None and sample_ids is not None:
+            cached = self.cache.lookup(sample_ids, masks.long().sum(1).tolist())
+
+        if cached is not None:
+            weight = self.bert.embeddings.word_embeddings.weight
+            rows = cached.to(weight.device).type_as(weight)
+            layer_out = rows.new_zeros(src_tokens.size() + (rows.size(-1),))
+            layer_out[masks] = rows
+        else:
+            grad_enabled = torch.is_grad_enabled() and self.args.no_freeze_bert
+            with torch.set_grad_enabled(grad_enabled):
+                layer_out = self.__run_bert(src_tokens, masks)
+            if self.cache is not None and sample_ids is not None:
+                self.cache.store(sample_ids, layer_out, masks)
 
-        with torch.no_grad():
-            bert_out = self.bert(src_tokens, torch.zeros_like(src_tokens),
-                masks)
+        if layer_out.dtype == torch.half and not getattr(self.args, 'fp16', False):
+            # Frozen half precision BERT feeding an fp32 decoder.
+            layer_out = layer_out.float()
 
-        encoder_out = bert_out[0][self.args.bert_layer].transpose(0, 1)
+        # fairseq 0.6's decoder attends over T x B x C; materialise that layout
+        # once rather than letting every cross-attention read a strided view.
+        encoder_out = layer_out.transpose(0, 1).contiguous()
 
         return {
             'encoder_out': encoder_out,
             'encoder_padding_mask': paddings
         }
 
+    def __run_bert(self, src_tokens, masks):
+        token_type_ids = self._zero_tti[:, :src_tokens.size(1)].expand(src_tokens.size(0), -1)
+        bert_out = self.bert(src_tokens, token_type_ids, masks)
+        return bert_out[0][self.args.bert_layer]
+
     def reorder_encoder_out(self, encoder_out, new_order):
-        return transformer.TransformerEncoder.reorder_encoder_out(self,
-            encoder_out, new_order)
+        encoder_out['encoder_out'] = encoder_out['encoder_out'].index_select(1, new_order)
+        if encoder_out['encoder_padding_mask'] is not None:
+            encoder_out['encoder_padding_mask'] = \
+                encoder_out['encoder_padding_mask'].index_select(0, new_order)
+        return encoder_out
 
     def max_positions(self) -> int:
         return 512
 
+    def make_generation_fast_(self, **kwargs):
+        # Only reached from generation, once the checkpoint (which holds fp32
+        # BERT weights) is loaded, so training and strict loading are unaffected.
+        # self.args are the training args, so the device cannot be inferred from
+        # them; bert_int8_cpu has to be requested through --model-overrides.
+        if self.args.bert_int8_cpu and self.args.bert_dtype == 'fp32' \
+                and hasattr(torch, 'quantization'):
+            torch.quantization.quantize_dynamic(self.bert, {torch.nn.Linear},
+                dtype=torch.qint8, inplace=True)
+            self.__quantized = True
+
+    def upgrade_state_dict_named(self, state_dict, name):
+        key = '{}._zero_tti'.format(name) if name else '_zero_tti'
+        if key not in state_dict:
+            state_dict[key] = self._zero_tti
+        return state_dict
+
 
 @register_model('bert_nmt')
 class BertTranslationModel(FairseqModel):
     @staticmethod
     def add_args(parser: argparse.ArgumentParser):
         parser.add_argument('--bert-layer', type=int)
+        parser.add_argument('--no-freeze-bert', action='store_true',
+                            help='fine-tune BERT together with the decoder')
+        parser.add_argument('--bert-dtype', choices=('fp32', 'fp16'), default='fp32',
+                            help='precision of the frozen BERT independent of the decoder')
+        parser.add_argument('--no-share-decoder-input-output-embed', action='store_true',
+                            help='use a separate decoder output projection instead of '
+                                 'tying it to the decoder input embedding')
+        parser.add_argument('--no-compile-decoder', action='store_true',
+                            help='do not wrap the decoder forward in torch.compile')
+        parser.add_argument('--bert-int8-cpu', action='store_true',
+                            help='apply int8 dynamic quantization to BERT when generating; '
+                                 'the model can then only run on CPU')
+        parser.add_argument('--cache-bert-output', action='store_true',
+                            help='store the output of the frozen BERT for every training '
+                                 'sentence in SAVE_DIR/bert_cache.bin and reuse it in later '
+                                 'epochs (single GPU training only)')
 
     @classmethod
     def build_model(cls, args: argparse.Namespace,
             task: translation.FairseqTask):
-        encoder = BertTranslationEncoder(args.bert_name)
+        # make sure all arguments are present in older models
+        bert_nmt_base(args)
+        if args.bert_dtype == 'fp16':
+            if args.no_freeze_bert:
+                raise ValueError('--bert-dtype fp16 requires a frozen BERT, drop --no-freeze-bert')
+            if getattr(args, 'cpu', False):
+                raise ValueError('--bert-dtype fp16 is not supported with --cpu')
+
+        # Only training has the train split loaded; generation never caches.
+        train_dataset = task.datasets.get(getattr(args, 'train_subset', 'train'))
+        encoder = BertTranslationEncoder(args, task.source_dictionary,
+            train_src_sizes=train_dataset.src_sizes if train_dataset is not None else None)
         decoder = cls.__build_transformer_decoder(args, task.target_dictionary)
+        if not args.no_compile_decoder and hasattr(torch, 'compile'):
+            # Compile forward() only; the module itself must stay a FairseqDecoder.
+            decoder.forward = torch.compile(decoder.forward, fullgraph=False)
         return BertTranslationModel(encoder, decoder)
 
+    def forward(self, src_tokens, src_lengths, prev_output_tokens, sample_ids=None):
+        encoder_out = self.encoder(src_tokens, src_lengths, sample_ids=sample_ids)
+        decoder_out = self.decoder(prev_output_tokens, encoder_out)
+        return decoder_out
+
+    def export_decoder_onnx(self, path, sample):
+        """Export the decoder to ONNX, e.g. to build a TensorRT engine with trtexec.
+
+        The frozen BERT stays outside the exported graph: its output is fed in
+        as ``encoder_out`` so beam search can keep running in Python. A CPU copy
+        of the decoder is traced, so the model itself is left unchanged.
+
+        Args:
+            path (str): destination of the ONNX file
+            sample (dict): a collated batch, only used to trace the graph
+        """
+        net_input = sample['net_input']
+        was_training = self.training
+        self.eval()
+        with torch.no_grad():
+            encoder_out = self.encoder(net_input['src_tokens'], net_input['src_lengths'])
+        self.train(was_training)
+
+        # A torch.compile'd forward bound on the instance cannot be deep-copied
+        # or traced, so the copy is taken without it.
+        compiled_forward = self.decoder.__dict__.pop('forward', None)
+        try:
+            decoder = copy.deepcopy(self.decoder).cpu().float()
+        finally:
+            if compiled_forward is not None:
+                self.decoder.forward = compiled_forward
+        decoder.eval()
+        # Switch positional embeddings and attention to traceable shapes so the
+        # dynamic axes below hold for other batch and sequence sizes.
+        decoder.apply(lambda m: m.prepare_for_onnx_export_()
+                      if hasattr(m, 'prepare_for_onnx_export_') else None)
+
+        with torch.no_grad():
+            torch.onnx.export(
+                _DecoderExportWrapper(decoder),
+                (net_input['prev_output_tokens'].cpu(), encoder_out['encoder_out'].cpu().float(),
+                 encoder_out['encoder_padding_mask'].cpu()),
+                path,
+                input_names=['prev_output_tokens', 'encoder_out', 'encoder_padding_mask'],
+                output_names=['logits'],
+                dynamic_axes={
+                    'prev_output_tokens': {0: 'B', 1: 'T'},
+                    'encoder_out': {0: 'L', 1: 'B'},
+                    'encoder_padding_mask': {0: 'B', 1: 'L'},
+                    'logits': {0: 'B', 1: 'T'},
+                },
+            )
+        return path
+
     @classmethod
     def __build_transformer_decoder(cls, args: argparse.Namespace,
             tgt_dict: Dictionary):
@@ -173,6 +454,11 @@ class BertTranslationModel(FairseqModel):
 
 @register_task('bert_translation')
 class BertTranslationTask(translation.TranslationTask):
+    # Batches are already bucketed by source length: LanguagePairDataset's
+    # ordered_indices() sorts by src size last, and batch_by_size() closes a
+    # batch once its padded size would exceed --max-tokens. The BERT encoder
+    # therefore only pads up to the longest sentence of each bucket, so
+    # get_batch_iterator() is deliberately not overridden here.
     @staticmethod
     def add_args(parser):
         """Add task-specific arguments to the parser."""
@@ -244,6 +530,13 @@ class BertTranslationTask(translation.TranslationTask):
 
         return cls(args, src_dict, tgt_dict)
 
+    def train_step(self, sample, model, criterion, optimizer, ignore_grad=False):
+        # Dummy batches reuse real ids with random sentences and must neither
+        # populate nor read the BERT output cache.
+        if getattr(self.args, 'cache_bert_output', False) and not sample.get('dummy', False):
+            sample['net_input']['sample_ids'] = sample['id']
+        return super().train_step(sample, model, criterion, optimizer, ignore_grad)
+
     @classmethod
     def load_dictionary(cls, filename):
         """Load the dictionary from the filename
@@ -277,6 +570,11 @@ class BertTranslationTask(translation.TranslationTask):
 @register_model_architecture('bert_nmt', 'bert_nmt')
 def bert_nmt_base(args: argparse.Namespace):
     args.bert_layer = getattr(args, 'bert_layer', -2)
+    args.no_freeze_bert = getattr(args, 'no_freeze_bert', False)
+    args.bert_dtype = getattr(args, 'bert_dtype', 'fp32')
+    args.bert_int8_cpu = getattr(args, 'bert_int8_cpu', False)
+    args.cache_bert_output = getattr(args, 'cache_bert_output', False)
+    args.no_compile_decoder = getattr(args, 'no_compile_decoder', False)
     args.decoder_embed_path = getattr(args, 'decoder_embed_path', None)
     if args.bert_name.find('base') >= 0:
         args.decoder_embed_dim = 768
@@ -292,7 +590,8 @@ def bert_nmt_base(args: argparse.Namespace):
     args.dropout = getattr(args, 'dropout', 0.1)
     args.adaptive_softmax_cutoff = getattr(args, 'adaptive_softmax_cutoff', None)
     args.adaptive_softmax_dropout = getattr(args, 'adaptive_softmax_dropout', 0)
-    args.share_decoder_input_output_embed = getattr(args, 'share_decoder_input_output_embed', False)
+    args.share_decoder_input_output_embed = getattr(args, 'share_decoder_input_output_embed',
+        not getattr(args, 'no_share_decoder_input_output_embed', False))
     args.share_all_embeddings = getattr(args, 'share_all_embeddings', False)
     args.no_token_positional_embeddings = getattr(args, 'no_token_positional_embeddings', False)
     args.adaptive_input = getattr(args, 'adaptive_input', False)